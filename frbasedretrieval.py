@@ -3,15 +3,27 @@
 # 2) expands frame typing with closeMatch and subsumedUnder
 # 3) computes common frame elements and WordNet synset label overlap per source–target pair
 #
-# Dependencies: pip install SPARQLWrapper pandas tqdm
+# Dependencies: pip install SPARQLWrapper requests ijson pandas tqdm pyarrow
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from SPARQLWrapper import SPARQLWrapper, JSON, POST, POSTDIRECTLY
+import argparse
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from tqdm import tqdm
+import os
+import gzip
+import hashlib
 import time
+import random
 
 FRAMESTER_SPARQL = "https://etna.istc.cnr.it/framester2/sparql"
 
+# On-disk cache of SPARQL results (gzipped JSON per query); None disables it
+CACHE_DIR = "framester_cache"
+CACHE_TTL_SEC = 24 * 60 * 60
+
 SELECTED_METAPHORS = [
     "https://w3id.org/framester/metanet/metaphors/GOVERNMENT_INSTITUTION_IS_A_BUILDING",
     "https://w3id.org/framester/metanet/metaphors/GOVERNMENT_IS_A_PERSON",
@@ -25,26 +37,133 @@ SELECTED_METAPHORS = [
     "https://w3id.org/framester/metanet/metaphors/DISEASE_TREATMENT_IS_WAR"
 ]
 
+# Shared keep-alive connection pool, so queries don't pay a TCP+TLS handshake each
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+class SessionSPARQLWrapper(SPARQLWrapper):
+    # SPARQLWrapper opens a fresh urllib connection per query; send it through SESSION instead
+    def _send(self, stream=False):
+        headers = {"Accept": "application/sparql-results+json"}
+        headers.update(self.customHttpHeaders)
+        if self.method == POST and self.requestMethod == POSTDIRECTLY:
+            headers["Content-Type"] = "application/sparql-query"
+            resp = SESSION.post(self.endpoint, data=self.queryString.encode("utf-8"), headers=headers, stream=stream)
+        elif self.method == POST:
+            resp = SESSION.post(self.endpoint, data={"query": self.queryString}, headers=headers, stream=stream)
+        else:
+            resp = SESSION.get(self.endpoint, params={"query": self.queryString}, headers=headers, stream=stream)
+        resp.raise_for_status()
+        return resp
+
+    def queryBindings(self, cache_path=None):
+        # Sends the query now, but reads the bindings lazily off the socket
+        resp = self._send(stream=True)
+        # SESSION already sends Accept-Encoding: gzip, deflate (the JSON results compress well);
+        # reading resp.raw directly only decompresses with decode_content set
+        resp.raw.decode_content = True
+        return iter_bindings(resp, cache_path)
+
+def iter_bindings(resp, cache_path=None):
+    # ijson walks results.bindings incrementally instead of json-loading the whole result document
+    with resp:
+        if cache_path is None:
+            yield from ijson.items(resp.raw, "results.bindings.item")
+            return
+        # Copy the raw JSON into the cache as it streams past; only publish it once fully read
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with gzip.open(tmp_path, "wb") as out:
+                yield from ijson.items(TeeReader(resp.raw, out), "results.bindings.item")
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class TeeReader:
+    def __init__(self, src, out):
+        self.src = src
+        self.out = out
+
+    def read(self, size=-1):
+        chunk = self.src.read(size)
+        self.out.write(chunk)
+        return chunk
+
+def iter_cached_bindings(cache_path):
+    with gzip.open(cache_path, "rb") as f:
+        yield from ijson.items(f, "results.bindings.item")
+
+def get_cache_path(query, endpoint):
+    # All queries are read-only SELECTs, so endpoint + query text is a safe cache key
+    key = hashlib.sha1(f"{endpoint}\n{query}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json.gz")
+
+# One SPARQLWrapper per endpoint, reused across queries
+_wrappers = {}
+
+def get_sparql(endpoint=FRAMESTER_SPARQL):
+    if endpoint not in _wrappers:
+        sparql = SessionSPARQLWrapper(endpoint)
+        sparql.setReturnFormat(JSON)
+        # POST the raw query body: VALUES-batched queries can exceed the endpoint's GET URL limit
+        sparql.setMethod(POST)
+        sparql.setRequestMethod(POSTDIRECTLY)
+        _wrappers[endpoint] = sparql
+    return _wrappers[endpoint]
+
 def run_sparql(query, endpoint=FRAMESTER_SPARQL, retries=3, sleep_sec=0.8):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setReturnFormat(JSON)
+    cache_path = None
+    if CACHE_DIR is not None:
+        cache_path = get_cache_path(query, endpoint)
+        if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < CACHE_TTL_SEC:
+            return list(iter_cached_bindings(cache_path))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    sparql = get_sparql(endpoint)
     sparql.setQuery(query)
     for attempt in range(retries):
         try:
-            return sparql.query().convert()
+            # Consume the stream here so a connection dropped mid-body is retried like any other failure
+            return list(sparql.queryBindings(cache_path))
         except Exception as e:
             if attempt == retries - 1:
                 raise
-            time.sleep(sleep_sec * (attempt + 1))
+            time.sleep(retry_delay(e, attempt, sleep_sec))
+
+MAX_RETRY_AFTER_SEC = 60
+
+def retry_delay(error, attempt, sleep_sec):
+    # Honour Retry-After on rate limiting; otherwise full-jitter exponential backoff so clients don't retry in lockstep
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code in (429, 503):
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            # Capped so a bogus header can't stall the run for hours
+            return min(int(retry_after), MAX_RETRY_AFTER_SEC)
+    return random.uniform(0, sleep_sec * (2 ** attempt))
+
+# SPARQL variable -> output column of the mappings table
+MAPPING_COLUMNS = {
+    "metaphor": "metaphor",
+    "src": "source_frame",
+    "tgt": "target_frame",
+    "srcRole": "source_role",
+    "tgtRole": "target_role",
+    "ent": "entailment",
+    "ex": "example"
+}
 
-def get_mappings_roles_entailments(metaphor_iri):
+def get_mappings_roles_entailments(metaphor_iris):
+    # One batched query for all metaphors; main() splits the result by metaphor
+    iri_list = " ".join(f"<{m}>" for m in metaphor_iris)
     q = f"""
     PREFIX metanet: <https://w3id.org/framester/metanet/schema/>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
     SELECT DISTINCT ?metaphor ?src ?tgt ?srcRole ?tgtRole ?ent ?ex
     WHERE {{
-      BIND(<{metaphor_iri}> AS ?metaphor)
+      VALUES ?metaphor {{ {iri_list} }}
       OPTIONAL {{ ?metaphor metanet:hasSourceFrame ?src. }}
       OPTIONAL {{ ?metaphor metanet:hasTargetFrame ?tgt. }}
       OPTIONAL {{ ?metaphor metanet:sourceRole ?srcRole. }}
@@ -53,86 +172,61 @@ def get_mappings_roles_entailments(metaphor_iri):
       OPTIONAL {{ ?metaphor metanet:hasExample ?ex. }}
     }}
     """
-    data = run_sparql(q)
-    rows = []
-    for b in data["results"]["bindings"]:
-        rows.append({
-            "metaphor": b.get("metaphor", {}).get("value"),
-            "source_frame": b.get("src", {}).get("value"),
-            "target_frame": b.get("tgt", {}).get("value"),
-            "source_role": b.get("srcRole", {}).get("value"),
-            "target_role": b.get("tgtRole", {}).get("value"),
-            "entailment": b.get("ent", {}).get("value"),
-            "example": b.get("ex", {}).get("value")
-        })
-    return rows
+    bindings = run_sparql(q)
+    # Column-oriented, so pandas builds each column once instead of inferring per row dict
+    cols = {col: [] for col in MAPPING_COLUMNS.values()}
+    for b in bindings:
+        for var, col in MAPPING_COLUMNS.items():
+            cols[col].append(b.get(var, {}).get("value"))
+    return pd.DataFrame(cols)
 
-def expand_equivalents_and_typing(frame_uri):
+def expand_equivalents_and_typing(frame_uris):
+    # All seeds in one query, aggregated server-side: one row per seed with space-separated candidate lists
+    frame_list = " ".join(f"<{f}>" for f in frame_uris)
     q = f"""
     PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
     PREFIX schema: <http://schema.org/>
     PREFIX metanet: <https://w3id.org/framester/metanet/schema/>
 
-    SELECT DISTINCT ?candidate ?typing
+    SELECT ?seed
+      (GROUP_CONCAT(DISTINCT STR(?cand); separator=" ") AS ?cands)
+      (GROUP_CONCAT(DISTINCT ?srcCand; separator=" ") AS ?srcCands)
+      (GROUP_CONCAT(DISTINCT ?tgtCand; separator=" ") AS ?tgtCands)
     WHERE {{
+      VALUES ?seed {{ {frame_list} }}
       {{
-        BIND(<{frame_uri}> AS ?seed)
         VALUES ?p {{ skos:closeMatch schema:subsumedUnder }}
-        {{ ?seed ?p ?candidate. }} UNION {{ ?candidate ?p ?seed. }}
+        {{ ?seed ?p ?cand. }} UNION {{ ?cand ?p ?seed. }}
       }}
       UNION
       {{
-        BIND(<{frame_uri}> AS ?candidate)
+        VALUES ?cand {{ {frame_list} }}
+        BIND(?cand AS ?seed)
       }}
 
-      BIND("none" AS ?typing)
-      BIND(COALESCE(?candidate, <{frame_uri}>) AS ?cand)
-
-      OPTIONAL {{
-        FILTER(BOUND(?cand))
-        ?m metanet:hasSourceFrame ?cand.
-        BIND("source" AS ?typing)
-      }}
-      OPTIONAL {{
-        FILTER(BOUND(?cand))
-        ?m2 metanet:hasTargetFrame ?cand.
-        BIND("target" AS ?typing2)
-      }}
+      BIND(IF(EXISTS {{ {{ ?ms metanet:hasSourceFrame ?cand }} UNION {{ ?cand metanet:hasSourceFrame ?xs }} }}, STR(?cand), "") AS ?srcCand)
+      BIND(IF(EXISTS {{ {{ ?mt metanet:hasTargetFrame ?cand }} UNION {{ ?cand metanet:hasTargetFrame ?xt }} }}, STR(?cand), "") AS ?tgtCand)
     }}
+    GROUP BY ?seed
     """
-    data = run_sparql(q)
-    src = set()
-    tgt = set()
-    cand_all = set()
-    for b in data["results"]["bindings"]:
-        c = b.get("candidate", {}).get("value", frame_uri)
-        cand_all.add(c)
-        t = b.get("typing", {}).get("value")
-        # typing2 may appear only in raw bindings, not as named var; we re-check below
-    # Second pass to type candidates robustly
-    for c in list(cand_all):
-        q2 = f"""
-        PREFIX metanet: <https://w3id.org/framester/metanet/schema/>
-        ASK {{ {{ ?m metanet:hasSourceFrame <{c}> }} UNION {{ <{c}> metanet:hasSourceFrame ?x }} }}
-        """
-        is_src = run_sparql(q2)["boolean"]
-        q3 = f"""
-        PREFIX metanet: <https://w3id.org/framester/metanet/schema/>
-        ASK {{ {{ ?m metanet:hasTargetFrame <{c}> }} UNION {{ <{c}> metanet:hasTargetFrame ?x }} }}
-        """
-        is_tgt = run_sparql(q3)["boolean"]
-        if is_src:
-            src.add(c)
-        if is_tgt:
-            tgt.add(c)
-    return {
-        "seed": frame_uri,
-        "candidates": list(cand_all),
-        "as_source": list(src),
-        "as_target": list(tgt)
-    }
+    bindings = run_sparql(q)
+    by_seed = {}
+    for b in bindings:
+        # Frame IRIs contain no whitespace; split() also drops the "" placeholders for untyped candidates
+        by_seed[b["seed"]["value"]] = {
+            "candidates": b.get("cands", {}).get("value", "").split(),
+            "as_source": b.get("srcCands", {}).get("value", "").split(),
+            "as_target": b.get("tgtCands", {}).get("value", "").split()
+        }
+    infos = []
+    for f in frame_uris:
+        info = by_seed.get(f, {"candidates": [f], "as_source": [], "as_target": []})
+        infos.append({"seed": f, **info})
+    return infos
 
-def get_frame_elements_and_synsets(frame_uri):
+def get_all_frame_elements_and_synsets(frame_uris):
+    # Every frame the overlap phase needs, in one query; rows carry ?f so they can be split per frame
+    frame_list = " ".join(f"<{f}>" for f in frame_uris)
     q = f"""
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
     PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
@@ -141,12 +235,15 @@ def get_frame_elements_and_synsets(frame_uri):
     PREFIX framenet: <https://w3id.org/framester/framenet/schema/>
     PREFIX wn: <https://w3id.org/framester/wn/wn30/schema/>
 
-    SELECT DISTINCT ?feLabel ?synLabel
+    SELECT DISTINCT ?f ?feLabel ?synLabel
     WHERE {{
-      BIND(<{frame_uri}> AS ?f)
+      VALUES ?f {{ {frame_list} }}
+
+      # Frame elements and synset labels come from separate UNION branches, so the
+      # endpoint returns |FE| + |synsets| rows per frame rather than their cross product
 
       # Frame elements through common patterns
-      OPTIONAL {{
+      {{
         ?f ?feRel ?fe .
         VALUES ?feRel {{
           framenet:fe framenet:frameElement
@@ -156,9 +253,9 @@ def get_frame_elements_and_synsets(frame_uri):
         OPTIONAL {{ ?fe rdfs:label ?feLabel. }}
         OPTIONAL {{ ?fe skos:prefLabel ?feLabel. }}
       }}
-
+      UNION
       # Synset labels linked from frame or its lexical units
-      OPTIONAL {{
+      {{
         {{ ?f skos:closeMatch ?syn. }} UNION {{ ?f schema:sameAs ?syn. }} UNION {{ ?f framenet:lu ?lu. ?lu skos:closeMatch ?syn. }}
         FILTER(CONTAINS(STR(?syn), "wn"))
         OPTIONAL {{ ?syn rdfs:label ?synLabel. }}
@@ -166,52 +263,65 @@ def get_frame_elements_and_synsets(frame_uri):
       }}
     }}
     """
-    data = run_sparql(q)
-    fe = set()
-    syn = set()
-    for b in data["results"]["bindings"]:
+    bindings = run_sparql(q)
+    fe = {f: set() for f in frame_uris}
+    syn = {f: set() for f in frame_uris}
+    for b in bindings:
+        f = b["f"]["value"]
         fe_lab = b.get("feLabel", {}).get("value")
         syn_lab = b.get("synLabel", {}).get("value")
         if fe_lab:
-            fe.add(fe_lab.strip())
+            fe[f].add(fe_lab.strip())
         if syn_lab:
-            syn.add(syn_lab.strip())
-    return sorted(fe), sorted(syn)
-
-def compute_overlap(source_frame, target_frame):
-    fe_src, syn_src = get_frame_elements_and_synsets(source_frame)
-    fe_tgt, syn_tgt = get_frame_elements_and_synsets(target_frame)
-    common_fe = sorted(set(fe_src) & set(fe_tgt))
-    common_syn = sorted(set(syn_src) & set(syn_tgt))
+            syn[f].add(syn_lab.strip())
+    return {f: (frozenset(fe[f]), frozenset(syn[f])) for f in frame_uris}
+
+OVERLAP_COLUMNS = [
+    "source_frame", "target_frame",
+    "n_common_frame_elements", "n_common_synset_labels",
+    "common_frame_elements", "common_synset_labels"
+]
+
+def compute_overlap(source_frame, target_frame, frame_sets):
+    # Pure in-memory intersection over the per-frame sets fetched once in main()
+    fe_src, syn_src = frame_sets[source_frame]
+    fe_tgt, syn_tgt = frame_sets[target_frame]
+    common_fe = fe_src & fe_tgt
+    common_syn = syn_src & syn_tgt
     return {
         "source_frame": source_frame,
         "target_frame": target_frame,
         "n_common_frame_elements": len(common_fe),
         "n_common_synset_labels": len(common_syn),
-        "common_frame_elements": "; ".join(common_fe),
-        "common_synset_labels": "; ".join(common_syn)
+        # Sorted tuples; joined into strings column-wise once the DataFrame is built
+        "common_frame_elements": tuple(sorted(common_fe)),
+        "common_synset_labels": tuple(sorted(common_syn))
     }
 
-def main():
-    all_map_rows = []
-    for m in tqdm(SELECTED_METAPHORS, desc="Fetching mappings and roles"):
-        rows = get_mappings_roles_entailments(m)
-        if not rows:
-            all_map_rows.append({
-                "metaphor": m, "source_frame": None, "target_frame": None,
-                "source_role": None, "target_role": None, "entailment": None, "example": None
-            })
-        else:
-            all_map_rows.extend(rows)
+def write_table(df, name, output_format="parquet"):
+    # Parquet by default; CSV kept for backward compatibility via --format csv
+    if output_format == "csv":
+        df.to_csv(f"{name}.csv", index=False)
+    else:
+        df.to_parquet(f"{name}.parquet", engine="pyarrow", compression="zstd", index=False)
 
-    df_map = pd.DataFrame(all_map_rows).drop_duplicates()
-    df_map.to_csv("metaphor_mappings_roles_entailments.csv", index=False)
+def main(output_format="parquet"):
+    print("Fetching mappings and roles")
+    df_found = get_mappings_roles_entailments(SELECTED_METAPHORS)
+    by_metaphor = dict(tuple(df_found.groupby("metaphor", sort=False)))
+    # Metaphors without any binding still get a placeholder row, in SELECTED_METAPHORS order
+    map_frames = [
+        by_metaphor.get(m, pd.DataFrame({"metaphor": [m]}, columns=list(MAPPING_COLUMNS.values())))
+        for m in SELECTED_METAPHORS
+    ]
+    df_map = pd.concat(map_frames, ignore_index=True).drop_duplicates()
+    write_table(df_map, "metaphor_mappings_roles_entailments", output_format)
 
     # Frame typing expansion for every distinct frame we saw
     unique_frames = sorted(set(df_map["source_frame"].dropna().tolist() + df_map["target_frame"].dropna().tolist()))
+    print("Expanding frame typing")
     typing_rows = []
-    for f in tqdm(unique_frames, desc="Expanding frame typing"):
-        info = expand_equivalents_and_typing(f)
+    for info in expand_equivalents_and_typing(unique_frames):
         typing_rows.append({
             "seed_frame": info["seed"],
             "equivalent_or_related_frames": "; ".join(sorted(info["candidates"])),
@@ -219,23 +329,39 @@ def main():
             "as_target": "; ".join(sorted(info["as_target"]))
         })
     df_type = pd.DataFrame(typing_rows)
-    df_type.to_csv("frame_typing_expanded.csv", index=False)
+    write_table(df_type, "frame_typing_expanded", output_format)
+
+    print("Fetching frame elements and synsets")
+    frame_sets = get_all_frame_elements_and_synsets(unique_frames)
 
+    # Roles, entailments and examples repeat each source-target pair many times; dedup before computing
+    pairs_df = df_map.dropna(subset=["source_frame", "target_frame"])
+    pairs = pairs_df[["source_frame", "target_frame"]].drop_duplicates()
     overlap_rows = []
-    for _, r in tqdm(df_map.dropna(subset=["source_frame", "target_frame"]).iterrows(), total=len(df_map.dropna(subset=["source_frame", "target_frame"])), desc="Computing overlaps"):
-        overlap_rows.append(compute_overlap(r["source_frame"], r["target_frame"]))
-    df_overlap = pd.DataFrame(overlap_rows).drop_duplicates()
-    df_overlap.to_csv("similarity_overlap.csv", index=False)
+    for s, t in tqdm(zip(pairs["source_frame"].to_numpy(), pairs["target_frame"].to_numpy()), total=len(pairs), desc="Computing overlaps"):
+        overlap_rows.append(compute_overlap(s, t, frame_sets))
+    df_overlap = pd.DataFrame(overlap_rows, columns=OVERLAP_COLUMNS)
+    for col in ["common_frame_elements", "common_synset_labels"]:
+        df_overlap[col] = df_overlap[col].str.join("; ").astype("string[pyarrow]")
+    write_table(df_overlap, "similarity_overlap", output_format)
 
     print("\nSummary")
     print(f"Metaphors processed: {len(SELECTED_METAPHORS)}")
-    print(f"Pairs with frames: {df_map.dropna(subset=['source_frame','target_frame']).shape[0]}")
+    print(f"Pairs with frames: {len(pairs_df)}")
     if not df_overlap.empty:
-        top = df_overlap.sort_values(["n_common_frame_elements","n_common_synset_labels"], ascending=False).head(5)
+        top = df_overlap.nlargest(5, ["n_common_frame_elements", "n_common_synset_labels"])
         print("\nTop pairs by surface overlap:")
-        for _, row in top.iterrows():
-            print(f"- {row['source_frame']} vs {row['target_frame']}  "
-                  f"FE overlap={row['n_common_frame_elements']}  SYN overlap={row['n_common_synset_labels']}")
+        for row in top.itertuples(index=False):
+            print(f"- {row.source_frame} vs {row.target_frame}  "
+                  f"FE overlap={row.n_common_frame_elements}  SYN overlap={row.n_common_synset_labels}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Frame-based extraction of the blending property from Framester")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet",
+                        help="output file format (default: parquet)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"always query the endpoint instead of reusing results cached in {CACHE_DIR}/")
+    args = parser.parse_args()
+    if args.no_cache:
+        CACHE_DIR = None
+    main(output_format=args.format)